@@ -1,30 +1,136 @@
 import runpod
 from runpod.serverless.utils import rp_upload
 import json
-import urllib.request
-import urllib.parse
 import time
 import os
-import requests
+import random
+import asyncio
+import aiohttp
 import base64
+import uuid
+import hashlib
+import threading
+import io
+import mimetypes
+import tempfile
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+# import orjson lib if available: (faster json encode/decode)
+# falls back to the stdlib json module when the wheel is missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Number of cpus this container may actually run on, os.cpu_count()
+# reports every cpu of the host which oversubscribes the thread pools
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+# must be set before onnxruntime (via nudenet) is imported
+os.environ.setdefault("OMP_NUM_THREADS", str(CPU_COUNT))
+os.environ.setdefault("MKL_NUM_THREADS", str(CPU_COUNT))
 
 # import nudenet lib: (nudity detection)
 # see: https://github.com/notAI-tech/NudeNet/tree/v3
+import onnxruntime
+import nudenet
 from nudenet import NudeDetector
 
 
-# Time to wait between API check attempts in milliseconds
-COMFY_API_AVAILABLE_INTERVAL_MS = 50
+# Maximum time to wait between API check attempts in milliseconds
+COMFY_API_AVAILABLE_INTERVAL_MS = 500
 # Maximum number of API check attempts
 COMFY_API_AVAILABLE_MAX_RETRIES = 500
-# Time to wait between poll attempts in milliseconds
-COMFY_POLLING_INTERVAL_MS = 250
-# Maximum number of poll attempts
-COMFY_POLLING_MAX_RETRIES = 999
+# Time to wait for a websocket message from ComfyUI in seconds
+# (any progress message resets the timeout, so this only fires on a stall)
+COMFY_WEBSOCKET_TIMEOUT_S = 250
+# Maximum number of attempts to fetch an image that ComfyUI reports as missing
+COMFY_VIEW_MAX_RETRIES = 5
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
-# The path where ComfyUI stores the generated images
-COMFY_OUTPUT_PATH = "/comfyui/output"
+# Base urls for the ComfyUI http api and websocket
+COMFY_URL = f"http://{COMFY_HOST}"
+COMFY_WS_URL = f"ws://{COMFY_HOST}/ws"
+
+# Strings that job_prop_to_bool treats as true
+TRUE_STRINGS = frozenset(("true", "t", "yes", "y", "ok", "1"))
+
+# Whether identical workflows return their cached output (see: WORKFLOW_CACHE_TTL_S)
+ENABLE_WORKFLOW_CACHE = os.environ.get("ENABLE_WORKFLOW_CACHE", "").strip().lower() in TRUE_STRINGS
+
+# Optional custom onnx model for nudenet (eg: a calibrated quantized model)
+# nudenet's own fp32 model is used when this is not set
+NUDENET_MODEL_PATH = os.environ.get("NUDENET_MODEL_PATH")
+
+# Time in seconds that a cached workflow result stays valid
+WORKFLOW_CACHE_TTL_S = int(os.environ.get("CACHE_TTL_SEC", 1800))
+# Maximum number of cached workflow results, the oldest is evicted first
+WORKFLOW_CACHE_MAX_ENTRIES = 256
+# Maximum total size in bytes of all cached workflow results (base64 images add up quickly)
+WORKFLOW_CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# Time in seconds that the presigned url of an uploaded image stays valid
+BUCKET_PRESIGNED_URL_EXPIRY_S = 604800
+# Maximum number of images of a single job uploaded at the same time
+BUCKET_MAX_CONCURRENT_UPLOADS = 8
+# Maximum number of parts of a single large image uploaded at the same time
+BUCKET_MAX_CONCURRENT_PARTS = 4
+# Transfer settings for image uploads, large images are sent in concurrent parts
+BUCKET_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=BUCKET_MAX_CONCURRENT_PARTS, use_threads=True)
+
+# Maximum number of jobs this worker handles at the same time
+# ComfyUI runs one prompt at a time, so higher values only overlap the
+# upload/encode work of one job with the generation of the next
+MAX_CONCURRENCY = int(os.environ.get("MAX_CONCURRENCY", 1))
+
+# Shared http session, keeps the connections to ComfyUI alive between requests
+# created on first use inside the event loop (see: _get_session)
+_session = None
+
+# Limits the number of jobs that talk to ComfyUI at the same time
+_job_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# Shared NudeDetector instance, created on first use (see: _get_nude_detector)
+_nude_detector = None
+
+# Shared s3 client, created on first upload (see: _get_s3_client)
+_s3_client = None
+
+# Cached job outputs keyed by workflow hash, values are (expiry, size, output)
+# only used when ENABLE_WORKFLOW_CACHE is set
+_workflow_cache = {}
+_workflow_cache_bytes = 0
+_workflow_cache_lock = threading.Lock()
+
+
+def json_dumps(obj, sort_keys=False):
+    """
+    Returns obj encoded as compact json bytes, using orjson when available
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, sort_keys=sort_keys, separators=(",", ":")).encode("utf-8")
+
+
+def json_loads(data):
+    """
+    Returns decoded json data (str or bytes), using orjson when available
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _get_session():
+    """
+    Returns the shared aiohttp session, creating it on first call
+    (must be called from within the running event loop).
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_CONCURRENCY * 2))
+    return _session
 
 
 def log(string):
@@ -49,11 +155,8 @@ def job_prop_to_bool(job_input, propname):
     bool: True if job_input dict has propname that seems bool-ish
     """
     value = job_input.get(propname)
-    if value is None: return False
-    if isinstance(value, bool): return value
-    true_strings = ['true', 't', 'yes', 'y', 'ok', '1']
-    if isinstance(value, str): return value.lower().strip() in true_strings
-    return False
+    if value is True or value is False or value is None: return bool(value)
+    return isinstance(value, str) and value.strip().lower() in TRUE_STRINGS
 
 
 def return_error(error_message):
@@ -70,52 +173,70 @@ def return_error(error_message):
     return {"error": error_message}
 
 
-def check_server(url, retries=50, delay=500):
+def _backoff(attempt, base_ms=25, cap_ms=500):
+    """
+    Returns exponential backoff with full jitter for the given attempt
+
+    Args:
+    - attempt (int): The zero based number of the attempt that just failed
+    - base_ms (int, optional): The delay in milliseconds for the first attempt. Default is 25
+    - cap_ms (int, optional): The maximum delay in milliseconds. Default is 500
+
+    Returns:
+    float: The time in seconds to sleep before the next attempt
+    """
+    return random.uniform(0, min(cap_ms, base_ms * (2 ** attempt))) / 1000
+
+
+async def check_server(url, retries=50, delay=500):
     """
     Check if a server is reachable via HTTP GET request
 
     Args:
     - url (str): The URL to check
     - retries (int, optional): The number of times to attempt connecting to the server. Default is 50
-    - delay (int, optional): The time in milliseconds to wait between retries. Default is 500
+    - delay (int, optional): The maximum time in milliseconds to wait between retries. Default is 500
 
     Returns:
     bool: True if the server is reachable within the given number of retries, otherwise False
     """
     for i in range(retries):
         try:
-            response = requests.get(url)
-            # If the response status code is 200, the server is up and running
-            if response.status_code == 200:
-                log(f"API is reachable")
-                return True
-        except requests.RequestException as e:
+            async with _get_session().get(url) as response:
+                # If the response status code is 200, the server is up and running
+                if response.status == 200:
+                    log(f"API is reachable")
+                    return True
+        except aiohttp.ClientError as e:
             # If an exception occurs, the server may not be ready
             pass
 
-        # Wait for the specified delay before retrying
-        time.sleep(delay/1000)
+        # Back off (up to the specified delay) before retrying
+        await asyncio.sleep(_backoff(i, cap_ms=delay))
 
     log(f"Failed to connect to server at {url} after {retries} attempts.")
     return False
 
 
-def queue_workflow(workflow):
+async def queue_workflow(workflow, client_id):
     """
     Queue a workflow to be processed by ComfyUI
 
     Args:
         workflow (dict): A dictionary containing the workflow to be processed
+        client_id (str): The websocket client ID that should receive the execution events
 
     Returns:
         dict: The JSON response from ComfyUI after processing the prompt
     """
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+    data = json_dumps({"prompt": workflow, "client_id": client_id})
+    headers = {"Content-Type": "application/json"}
+    async with _get_session().post(f"{COMFY_URL}/prompt", data=data, headers=headers) as response:
+        response.raise_for_status()
+        return await response.json(loads=json_loads)
 
 
-def get_history(prompt_id):
+async def get_history(prompt_id):
     """
     Retrieve the history of a given prompt using its ID
 
@@ -125,35 +246,391 @@ def get_history(prompt_id):
     Returns:
         dict: The history of the prompt, containing all the processing steps and results
     """
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
-        return json.loads(response.read())
+    async with _get_session().get(f"{COMFY_URL}/history/{prompt_id}") as response:
+        response.raise_for_status()
+        return await response.json(loads=json_loads)
+
+
+async def fetch_image(image):
+    """
+    Download a generated image from ComfyUI
+
+    Args:
+        image (dict): The image entry from the prompt history (filename, subfolder and type)
+
+    Returns:
+        bytes: The image data
+    """
+    params = {"filename": image["filename"], "subfolder": image.get("subfolder", ""), "type": image.get("type", "output")}
+    for i in range(COMFY_VIEW_MAX_RETRIES):
+        async with _get_session().get(f"{COMFY_URL}/view", params=params) as response:
+            # the file may not be flushed to disk yet on a slow disk, back off and try again
+            if response.status == 404 and i < COMFY_VIEW_MAX_RETRIES - 1:
+                await asyncio.sleep(_backoff(i))
+                continue
+            response.raise_for_status()
+            return await response.read()
+
+
+async def wait_for_completion(ws, prompt_id):
+    """
+    Wait on the ComfyUI websocket until the given prompt has finished executing
+
+    Args:
+        ws (aiohttp.ClientWebSocketResponse): A websocket connected to ComfyUI with our client ID
+        prompt_id (str): The ID of the prompt to wait for
+
+    Raises:
+        RuntimeError: If ComfyUI reports an execution error for the prompt or closes the websocket
+        asyncio.TimeoutError: If no message arrives within the timeout
+    """
+    while True:
+        message = await ws.receive(timeout=COMFY_WEBSOCKET_TIMEOUT_S)
+        if message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+            raise RuntimeError("ComfyUI websocket closed unexpectedly")
+        # binary messages are latent previews, we only care about status events
+        if message.type != aiohttp.WSMsgType.TEXT:
+            continue
+        message = json_loads(message.data)
+        data = message.get("data", {})
+        if data.get("prompt_id") != prompt_id:
+            continue
+        if message["type"] == "execution_error":
+            raise RuntimeError(data.get("exception_message", "ComfyUI execution error"))
+        if message["type"] == "execution_success":
+            return
+        if message["type"] == "executing" and data.get("node") is None:
+            return
+
+
+def _get_s3_client():
+    """
+    Returns the shared s3 client for the bucket configured in env,
+    or None if the bucket credentials have not been set.
+    """
+    global _s3_client
+    if _s3_client is None:
+        endpoint_url = os.environ.get("BUCKET_ENDPOINT_URL")
+        access_key_id = os.environ.get("BUCKET_ACCESS_KEY_ID")
+        secret_access_key = os.environ.get("BUCKET_SECRET_ACCESS_KEY")
+        if not (endpoint_url and access_key_id and secret_access_key):
+            return None
+        _s3_client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+            # same region parsing as runpod upload, also covers non aws endpoints
+            region_name=rp_upload.extract_region_from_url(endpoint_url),
+            config=Config(
+                signature_version="s3v4",
+                retries={"max_attempts": 3, "mode": "standard"},
+                # one connection for every part that may be in flight across all jobs,
+                # otherwise botocore's default pool of 10 discards the keep-alive sockets
+                max_pool_connections=MAX_CONCURRENCY * BUCKET_MAX_CONCURRENT_UPLOADS * BUCKET_MAX_CONCURRENT_PARTS,
+            ),
+        )
+    return _s3_client
+
+
+def upload_image(job_id, filename, img_bytes, subfolder=""):
+    """
+    Uploads image to the bucket configured in env.
+    Falls back to runpod upload when no bucket credentials have been set.
+
+    Args:
+    - job_id (str): The ID of the job the image belongs to
+    - filename (str): The filename ComfyUI gave the image
+    - img_bytes (bytes): The image data
+    - subfolder (str, optional): The ComfyUI output subfolder of the image. Default is ""
+
+    Returns:
+    str: presigned url of the uploaded image
+    """
+    s3_client = _get_s3_client()
+    if s3_client is None:
+        # runpod upload only takes a path, so write the image out for it
+        with tempfile.TemporaryDirectory() as temp_dir:
+            img_file = os.path.join(temp_dir, filename)
+            with open(img_file, "wb") as image_file:
+                image_file.write(img_bytes)
+            return rp_upload.upload_image(job_id, img_file)
+    # same bucket/key layout as runpod upload, keeping the subfolder
+    # so equal filenames from different subfolders don't overwrite each other
+    bucket = time.strftime("%m-%y")
+    key = "/".join(part for part in (job_id, subfolder.strip("/"), filename) if part)
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    # BytesIO over immutable bytes shares the buffer, the image isn't copied
+    s3_client.upload_fileobj(
+        io.BytesIO(img_bytes), bucket, key,
+        ExtraArgs={"ContentType": content_type},
+        Config=BUCKET_TRANSFER_CONFIG,
+    )
+    return s3_client.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": key},
+        ExpiresIn=BUCKET_PRESIGNED_URL_EXPIRY_S,
+    )
+
+
+async def upload_images(job_id, images, images_bytes):
+    """
+    Uploads all images of a job side by side (see: upload_image)
+
+    Args:
+    - job_id (str): The ID of the job the images belong to
+    - images (list): The image entries from the prompt history
+    - images_bytes (list): The image data for each of images
+
+    Returns:
+    list: url of each uploaded image, in the same order as images
+    """
+    semaphore = asyncio.Semaphore(BUCKET_MAX_CONCURRENT_UPLOADS)
+
+    async def upload(image, img_bytes):
+        async with semaphore:
+            return await asyncio.to_thread(upload_image, job_id, image["filename"], img_bytes, image.get("subfolder", ""))
+
+    return await asyncio.gather(*(upload(image, img_bytes) for image, img_bytes in zip(images, images_bytes)))
 
 
-def base64_encode(img_file):
+def base64_encode(img_bytes):
     """
     Returns base64 encoded image.
     """
-    log(f"scanning base64 for {img_file}")
-    with open(img_file, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read())
-        return encoded_string.decode("utf-8")
+    return base64.b64encode(img_bytes).decode("ascii")
     
 
-def detect_nudity(img_file):
+def is_workflow_deterministic(workflow):
     """
+    Checks if a workflow will produce the same images each time it runs
+
+    Args:
+    - workflow (dict): The ComfyUI workflow to check
+
     Returns:
-    list: of detected nudity for img_file if able
+    bool: False if any node has a "seed" or "noise_seed" of -1, otherwise True
+    """
+    for node in workflow.values():
+        inputs = node.get("inputs", {}) if isinstance(node, dict) else {}
+        if inputs.get("seed") == -1 or inputs.get("noise_seed") == -1:
+            return False
+    return True
+
+
+def workflow_cache_key(workflow, *flags):
     """
-    log(f"scanning nudity for {img_file}")
-    return NudeDetector().detect(img_file) 
+    Returns sha256 hash of the canonical workflow json and any extra flags
+    that change the job output (eg: return-nsfw)
+    """
+    canonical = json_dumps([workflow, flags], sort_keys=True)
+    return hashlib.sha256(canonical).hexdigest()
 
 
-def handler(job):
+def get_cached_output(key):
+    """
+    Returns:
+    dict: the cached job output for key, or None if missing or expired
+    """
+    with _workflow_cache_lock:
+        entry = _workflow_cache.get(key)
+        if entry is None:
+            return None
+        expiry, size, output = entry
+        if expiry < time.monotonic():
+            _evict_cached_output(key)
+            return None
+        return output
+
+
+def _evict_cached_output(key):
+    """
+    Removes key from the cache, must be called with _workflow_cache_lock held
+    """
+    global _workflow_cache_bytes
+    entry = _workflow_cache.pop(key, None)
+    if entry is not None:
+        _workflow_cache_bytes -= entry[1]
+
+
+def set_cached_output(key, output):
+    """
+    Stores job output for key, evicting the oldest entries until both the
+    entry and byte limits fit. Outputs larger than the byte limit aren't cached.
+    """
+    global _workflow_cache_bytes
+    size = len(json_dumps(output))
+    if size > WORKFLOW_CACHE_MAX_BYTES:
+        return
+    with _workflow_cache_lock:
+        _evict_cached_output(key)
+        while _workflow_cache and (
+            len(_workflow_cache) >= WORKFLOW_CACHE_MAX_ENTRIES
+            or _workflow_cache_bytes + size > WORKFLOW_CACHE_MAX_BYTES
+        ):
+            _evict_cached_output(next(iter(_workflow_cache)))
+        _workflow_cache[key] = (time.monotonic() + WORKFLOW_CACHE_TTL_S, size, output)
+        _workflow_cache_bytes += size
+
+
+def _create_nude_detector(model_path=None):
+    """
+    Returns new NudeDetector whose onnx session uses CPU_COUNT threads.
+    NudeDetector has no session options argument, so its session is
+    rebuilt from the same model with the options once it is created.
+    """
+    detector = NudeDetector(model_path=model_path) if model_path else NudeDetector()
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = CPU_COUNT
+    session_options.inter_op_num_threads = 1
+    session_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    # nudenet falls back to the 320n model shipped next to its module
+    model_path = model_path or os.path.join(os.path.dirname(nudenet.__file__), "320n.onnx")
+    detector.onnx_session = onnxruntime.InferenceSession(
+        model_path,
+        sess_options=session_options,
+        providers=detector.onnx_session.get_providers(),
+    )
+    return detector
+
+
+def _get_nude_detector():
+    """
+    Returns the shared NudeDetector, loading the model on first call so
+    later jobs can reuse the already initialized onnx session.
+    """
+    global _nude_detector
+    if _nude_detector is None:
+        if NUDENET_MODEL_PATH:
+            log(f"loading nudenet model from {NUDENET_MODEL_PATH}")
+            _nude_detector = _create_nude_detector(model_path=NUDENET_MODEL_PATH)
+        else:
+            _nude_detector = _create_nude_detector()
+    return _nude_detector
+
+
+def detect_nudity_batch(img_bytes_list):
+    """
+    Returns:
+    list: of detected nudity lists, one for each image in img_bytes_list
+    """
+    log(f"scanning nudity for {len(img_bytes_list)} image(s)")
+    detector = _get_nude_detector()
+    # older nudenet releases have no detect_batch, scan the images one by one
+    if not hasattr(detector, "detect_batch"):
+        return [detector.detect(img_bytes) for img_bytes in img_bytes_list]
+    return detector.detect_batch(img_bytes_list)
+
+
+async def run_workflow(job_id, workflow, want_nsfw, want_b64):
+    """
+    Runs workflow on ComfyUI and collects the generated images
+
+    Args:
+        job_id (str): The ID of the job, used for the upload path
+        workflow (dict): The ComfyUI workflow to run
+        want_nsfw (bool): Whether to check the images for nudity
+        want_b64 (bool): Whether to return base64 for images not uploaded to aws
+
+    Returns:
+        dict: A dictionary containing either an error message or the generated images.
+    """
+    # Connect to the websocket before queuing so no execution event is missed
+    client_id = str(uuid.uuid4())
+    try:
+        ws = await _get_session().ws_connect(f"{COMFY_WS_URL}?clientId={client_id}")
+    except Exception as e:
+        return return_error(f"Error connecting to ComfyUI websocket: {str(e)}")
+
+    async with ws:
+        # Queue the prompt
+        try:
+            queued = await queue_workflow(workflow, client_id)
+            comfy_job_id = queued["prompt_id"]
+            log(f"ComfyUI queued with job ID {comfy_job_id}")
+        except Exception as e:
+            return return_error(f"Error queuing prompt: {str(e)}")
+
+        # Wait for completion
+        log(f"wait until image generation is complete")
+        try:
+            await wait_for_completion(ws, comfy_job_id)
+        except asyncio.TimeoutError:
+            return return_error(f"Timed out while waiting for image generation")
+        except Exception as e:
+            return return_error(f"Error waiting for image generation: {str(e)}")
+
+    try:
+        history = await get_history(comfy_job_id)
+    except Exception as e:
+        return return_error(f"Error fetching history: {str(e)}")
+
+    if not history.get(comfy_job_id, {}).get("outputs"):
+        return return_error(f"No outputs found in history for job ID {comfy_job_id}")
+
+    # Fetching generated images
+    outputs = history[comfy_job_id].get("outputs")
+    # only saved images, previews (type "temp") are not part of the result
+    images = [
+        image
+        for node_output in outputs.values()
+        for image in node_output.get("images", ())
+        if image.get("type", "output") == "output"
+    ]
+
+    log(f"image generation is done")
+
+    if not images:
+        return return_error(f"No images found in outputs for job ID {comfy_job_id}")
+
+    # download the images straight from ComfyUI, no shared output folder needed
+    try:
+        images_bytes = await asyncio.gather(*(fetch_image(image) for image in images))
+    except Exception as e:
+        return return_error(f"Error fetching generated images: {str(e)}")
+    log(f"fetched {len(images_bytes)} image(s) from ComfyUI")
+    # each image is held once in memory, the upload, nudity check and
+    # base64 encode below all read the same (read-only) bytes object
+
+    # decide up front which work is needed: images only go to aws when
+    # the bucket credentials are set, otherwise base64 is the only way
+    # to get them back, so only encode when the upload is simulated
+    aws_upload = _get_s3_client() is not None
+    want_b64 = want_b64 and not aws_upload
+
+    async def no_result():
+        return None
+
+    # run the uploads, nudity check and base64 encodes side by side in threads,
+    # as the upload is network bound while the others are local work
+    image_urls, nsfw_results, b64_results = await asyncio.gather(
+        # attempt aws image upload, will only work when aws credts have been set in env
+        # ~ otherwise runpod upload simulates the upload
+        upload_images(job_id, images, images_bytes),
+        # check generated images for nudity in one batch if flag set
+        asyncio.to_thread(detect_nudity_batch, images_bytes) if want_nsfw else no_result(),
+        # convert generated images to base64 if not uploaded to aws and able
+        asyncio.to_thread(lambda: [base64_encode(img_bytes) for img_bytes in images_bytes]) if want_b64 else no_result(),
+    )
+
+    job_output = {"images": []}
+    for index, image_url in enumerate(image_urls):
+        # setup base return object structure
+        image_output = {"url": image_url}
+        if nsfw_results is not None:
+            image_output["nsfw"] = nsfw_results[index]
+        if b64_results is not None:
+            image_output["base64"] = b64_results[index]
+        job_output["images"].append(image_output)
+    return job_output
+
+
+async def handler(job):
     """
     The main function that handles a job of generating an image.
 
     This function validates the input, sends a prompt to ComfyUI for processing,
-    polls ComfyUI for result, and retrieves generated images.
+    waits on the ComfyUI websocket for the result, and retrieves generated images.
 
     Args:
         job (dict): A dictionary containing job details and input parameters.
@@ -162,7 +639,6 @@ def handler(job):
         dict: A dictionary containing either an error message or a success status with generated images.
     """
     job_input = job["input"]
-    job_output = {}
 
     # Validate inputs
     if job_input is None:
@@ -176,7 +652,7 @@ def handler(job):
     # if workflow is a string then try convert to json
     if isinstance(workflow, str):
         try:
-            workflow = json.loads(workflow)
+            workflow = json_loads(workflow)
         except json.JSONDecodeError:
             return return_error(f"Invalid JSON format in 'workflow' data")
         
@@ -184,76 +660,51 @@ def handler(job):
     if not isinstance(workflow, dict):
         return return_error(f"'workflow' must be a JSON object or JSON-encoded string")
     
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    )
+    want_nsfw = job_prop_to_bool(job_input, "return-nsfw")
+    want_b64 = job_prop_to_bool(job_input, "return-b64")
 
-    # Queue the prompt
-    try:
-        queued = queue_workflow(workflow)
-        comfy_job_id = queued["prompt_id"]
-        log(f"ComfyUI queued with job ID {comfy_job_id}")
-    except Exception as e:
-        return return_error(f"Error queuing prompt: {str(e)}")
+    # return the previous output for identical workflows if caching is enabled
+    cache_key = None
+    if ENABLE_WORKFLOW_CACHE and is_workflow_deterministic(workflow):
+        cache_key = workflow_cache_key(workflow, want_nsfw, want_b64)
+        cached_output = get_cached_output(cache_key)
+        if cached_output is not None:
+            log(f"returning cached output for workflow {cache_key}")
+            return cached_output
 
-    # Poll for completion
-    log(f"wait until image generation is complete")
-    retries = 0
-    try:
-        while retries < COMFY_POLLING_MAX_RETRIES:
-            history = get_history(comfy_job_id)
-
-            # Exit the loop if we have found the history
-            if comfy_job_id in history and history[comfy_job_id].get("outputs"):
-                break
-            else:
-                # Wait before trying again
-                time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
-        else:
-            return return_error(f"Max retries reached while waiting for image generation")
-    except Exception as e:
-        return return_error(f"Error waiting for image generation: {str(e)}")
+    async with _job_semaphore:
+        job_output = await run_workflow(job["id"], workflow, want_nsfw, want_b64)
 
-    # Fetching generated images
-    output_images = {}
+    if cache_key is not None and "error" not in job_output:
+        set_cached_output(cache_key, job_output)
+    return job_output
 
-    outputs = history[comfy_job_id].get("outputs")
 
-    for node_id, node_output in outputs.items():
-        if "images" in node_output:
-            for image in node_output["images"]:
-                output_images = image["filename"]
+async def wait_for_server():
+    """
+    Waits until the ComfyUI API is available, then closes the session
+    so that the handler creates its own within runpod's event loop.
 
-    log(f"image generation is done")
+    Returns:
+    bool: True if the server is reachable, otherwise False
+    """
+    try:
+        return await check_server(COMFY_URL, COMFY_API_AVAILABLE_MAX_RETRIES, COMFY_API_AVAILABLE_INTERVAL_MS)
+    finally:
+        await _get_session().close()
 
-    # expected image output folder
-    local_image_path = f"{COMFY_OUTPUT_PATH}/{output_images}"
-    # The image is in the output folder
-    if os.path.exists(local_image_path):
-        log("the image exists in the output folder")
-        # use runpod upload to attempt aws image upload
-        # will only work when aws credts have been set in env, 
-        # ~ or are given when sending the job request
-        image_url = rp_upload.upload_image(job["id"], local_image_path)
-        # check image_url to see if was uploaded to aws
-        aws_uploaded = "simulated_uploaded/" not in image_url
-        # setup base return object structure
-        job_output["url"] = image_url
-        # check generated image for nudity if flag set
-        if job_prop_to_bool(job_input, "return-nsfw"):
-            job_output["nsfw"] = detect_nudity(local_image_path)
-        # convert generated image to base64 if not uploaded to aws and able
-        if not aws_uploaded and job_prop_to_bool(job_input, "return-b64"):
-            job_output["base64"] = base64_encode(local_image_path)
-        # else return image url
-        return job_output
-    # image wasnt found in the output folder, no need for else
-    return return_error(f"image does not exist in the specified output folder: {local_image_path}")
 
+# Make sure that the ComfyUI API is available once per container, not per job
+if not asyncio.run(wait_for_server()):
+    raise SystemExit("ComfyUI did not come up")
+
+# Load the nudenet model and s3 client up front so the first job doesn't pay for it
+_get_nude_detector()
+_get_s3_client()
 
 # Start the handler
-runpod.serverless.start({"handler": handler})
+runpod.serverless.start({
+    "handler": handler,
+    # let runpod hand this worker up to MAX_CONCURRENCY jobs at once
+    "concurrency_modifier": lambda current_concurrency: MAX_CONCURRENCY,
+})